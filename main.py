@@ -1,342 +1,776 @@
-import sqlite3
-import json
-import hashlib
-import re
-from datetime import datetime
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
-from pydantic import BaseModel
-from typing import Dict, List, Optional
-
-app = FastAPI()
-
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-# --- BASE DE DATOS ---
-def init_db():
-    # TIMEOUT AUMENTADO A 30 SEGUNDOS
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS mensajes
-                 (id INTEGER PRIMARY KEY AUTOINCREMENT, sender TEXT, recipient TEXT, message TEXT, timestamp TEXT, is_group INTEGER)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS usuarios
-                 (username TEXT PRIMARY KEY, password_hash TEXT, avatar TEXT, about TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS grupos
-                 (nombre TEXT PRIMARY KEY, creador TEXT, miembros TEXT)''')
-    conn.commit()
-    conn.close()
-
-init_db()
-
-# --- FUNCIONES ---
-def encriptar(password):
-    return hashlib.sha256(password.encode()).hexdigest()
-
-def validar_password_fuerte(password):
-    if len(password) < 8: return "Mínimo 8 caracteres."
-    if not re.search(r"[A-Z]", password): return "Falta una mayúscula."
-    if not re.search(r"[a-z]", password): return "Falta una minúscula."
-    if not re.search(r"\d", password): return "Falta un número."
-    return True
-
-def guardar_mensaje_db(sender, recipient, message, timestamp, is_group):
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("INSERT INTO mensajes (sender, recipient, message, timestamp, is_group) VALUES (?, ?, ?, ?, ?)", 
-              (sender, recipient, message, timestamp, 1 if is_group else 0))
-    conn.commit()
-    nuevo_id = c.lastrowid
-    conn.close()
-    return nuevo_id
-
-def borrar_mensaje_db(msg_id, sender):
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("DELETE FROM mensajes WHERE id = ? AND sender = ?", (msg_id, sender))
-    borrados = c.rowcount
-    conn.commit()
-    conn.close()
-    return borrados > 0
-
-def obtener_mensajes_db():
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("SELECT id, sender, recipient, message, timestamp, is_group FROM mensajes")
-    mensajes = c.fetchall()
-    conn.close()
-    return [{"id": m[0], "sender": m[1], "recipient": m[2], "message": m[3], "timestamp": m[4], "is_group": bool(m[5])} for m in mensajes]
-
-def obtener_usuarios_db():
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("SELECT username, avatar, about FROM usuarios")
-    users = c.fetchall()
-    conn.close()
-    return [{"username": u[0], "avatar": u[1] if u[1] else "", "about": u[2] if u[2] else "¡Hola! Uso TecChat"} for u in users]
-
-def actualizar_avatar_db(username, nueva_url):
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("UPDATE usuarios SET avatar = ? WHERE username = ?", (nueva_url, username))
-    conn.commit()
-    conn.close()
-
-def actualizar_about_db(username, nuevo_about):
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("UPDATE usuarios SET about = ? WHERE username = ?", (nuevo_about, username))
-    conn.commit()
-    conn.close()
-
-def crear_grupo_db(nombre, creador, miembros_lista):
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    miembros_json = json.dumps(miembros_lista)
-    try:
-        c.execute("INSERT INTO grupos VALUES (?, ?, ?)", (nombre, creador, miembros_json))
-        conn.commit()
-        return True
-    except sqlite3.IntegrityError:
-        return False
-    finally:
-        conn.close()
-
-def obtener_info_grupo_db(nombre_grupo):
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("SELECT creador, miembros FROM grupos WHERE nombre = ?", (nombre_grupo,))
-    row = c.fetchone()
-    conn.close()
-    if row:
-        return {"nombre": nombre_grupo, "creador": row[0], "miembros": json.loads(row[1])}
-    return None
-
-def modificar_miembros_grupo_db(nombre_grupo, nueva_lista):
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    miembros_json = json.dumps(nueva_lista)
-    c.execute("UPDATE grupos SET miembros = ? WHERE nombre = ?", (miembros_json, nombre_grupo))
-    conn.commit()
-    conn.close()
-
-def obtener_grupos_usuario(username):
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("SELECT nombre, miembros FROM grupos")
-    todos = c.fetchall()
-    conn.close()
-    mis_grupos = []
-    for g in todos:
-        miembros = json.loads(g[1])
-        if username in miembros:
-            mis_grupos.append({"nombre": g[0], "miembros": miembros})
-    return mis_grupos
-
-# --- MODELOS ---
-class UserAuth(BaseModel):
-    username: str
-    password: str
-
-class UserUpdate(BaseModel):
-    username: str
-    avatar_url: Optional[str] = None
-    about: Optional[str] = None
-
-class NewGroup(BaseModel):
-    nombre: str
-    creador: str
-    miembros: List[str]
-
-class GroupAction(BaseModel):
-    nombre_grupo: str
-    solicitante: str
-    target_user: str
-
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-
-    async def connect(self, websocket: WebSocket, client_id: str):
-        await websocket.accept()
-        self.active_connections[client_id] = websocket
-        await self.broadcast_refresh() 
-        await self.broadcast_online_list()
-
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
-            del self.active_connections[client_id]
-
-    async def broadcast_online_list(self):
-        online_users = list(self.active_connections.keys())
-        msg = json.dumps({"type": "STATUS", "online_users": online_users})
-        for conn in self.active_connections.values():
-            await conn.send_text(msg)
-
-    async def broadcast_refresh(self):
-        msg = json.dumps({"type": "REFRESH_USERS"})
-        for conn in self.active_connections.values():
-            await conn.send_text(msg)
-
-    async def send_personal_message(self, message_json: str, recipient_id: str):
-        if recipient_id in self.active_connections:
-            await self.active_connections[recipient_id].send_text(message_json)
-
-    async def broadcast(self, message_json: str):
-        for conn in self.active_connections.values():
-            await conn.send_text(message_json)
-
-    async def broadcast_to_group(self, message_json: str, members_list: List[str]):
-        for member in members_list:
-            if member in self.active_connections:
-                await self.active_connections[member].send_text(message_json)
-
-manager = ConnectionManager()
-
-# --- RUTAS ---
-
-@app.get("/")
-async def get():
-    return RedirectResponse(url="/static/index.html")
-
-@app.post("/login")
-async def login(user: UserAuth):
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("SELECT password_hash FROM usuarios WHERE username = ?", (user.username,))
-    row = c.fetchone()
-    conn.close()
-    if not row: raise HTTPException(status_code=404, detail="Usuario no encontrado.")
-    if row[0] != encriptar(user.password): raise HTTPException(status_code=401, detail="Contraseña incorrecta.")
-    return {"message": "Login exitoso"}
-
-@app.post("/signup")
-async def signup(user: UserAuth):
-    val = validar_password_fuerte(user.password)
-    if val != True: raise HTTPException(status_code=400, detail=val)
-
-    # TIMEOUT AUMENTADO
-    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
-    c = conn.cursor()
-    c.execute("SELECT username FROM usuarios WHERE username = ?", (user.username,))
-    if c.fetchone():
-        conn.close()
-        raise HTTPException(status_code=400, detail="Usuario existente.")
-    c.execute("INSERT INTO usuarios VALUES (?, ?, ?, ?)", (user.username, encriptar(user.password), None, "Disponible"))
-    conn.commit()
-    conn.close()
-    return {"message": "Creado"}
-
-@app.post("/update-avatar")
-async def update_avatar(data: UserUpdate):
-    actualizar_avatar_db(data.username, data.avatar_url)
-    return {"message": "Avatar actualizado"}
-
-@app.post("/update-about")
-async def update_about(data: UserUpdate):
-    actualizar_about_db(data.username, data.about)
-    return {"message": "Estado actualizado"}
-
-@app.post("/crear-grupo")
-async def create_group(grupo: NewGroup):
-    members = list(set(grupo.miembros))
-    if grupo.creador not in members: members.append(grupo.creador)
-    if len(members) < 1: raise HTTPException(status_code=400, detail="Faltan miembros")
-    exito = crear_grupo_db(grupo.nombre, grupo.creador, members)
-    if not exito: raise HTTPException(status_code=400, detail="El grupo ya existe")
-    return {"message": "Grupo creado"}
-
-@app.get("/mis-grupos/{username}")
-async def get_my_groups(username: str):
-    return obtener_grupos_usuario(username)
-
-@app.get("/grupo/{nombre}")
-async def get_group_info(nombre: str):
-    return obtener_info_grupo_db(nombre)
-
-@app.post("/grupo/agregar")
-async def add_member(action: GroupAction):
-    info = obtener_info_grupo_db(action.nombre_grupo)
-    if not info: raise HTTPException(404, "Grupo no existe")
-    if action.solicitante not in info["miembros"]: raise HTTPException(403, "No eres del grupo")
-    if action.target_user not in info["miembros"]:
-        info["miembros"].append(action.target_user)
-        modificar_miembros_grupo_db(action.nombre_grupo, info["miembros"])
-    return {"message": "Agregado"}
-
-@app.post("/grupo/expulsar")
-async def kick_member(action: GroupAction):
-    info = obtener_info_grupo_db(action.nombre_grupo)
-    if not info: raise HTTPException(404, "Grupo no existe")
-    if info["creador"] != action.solicitante: raise HTTPException(403, "Solo el creador puede expulsar")
-    if action.target_user in info["miembros"]:
-        info["miembros"].remove(action.target_user)
-        modificar_miembros_grupo_db(action.nombre_grupo, info["miembros"])
-    return {"message": "Expulsado"}
-
-@app.get("/lista-usuarios/")
-async def get_users():
-    return obtener_usuarios_db()
-
-@app.get("/historial")
-async def get_history():
-    return obtener_mensajes_db()
-
-@app.websocket("/ws/{client_id}")
-async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    await manager.connect(websocket, client_id)
-    try:
-        now = datetime.utcnow().isoformat() + "Z"
-        sys_msg = json.dumps({"type": "CHAT", "sender": "Sistema", "recipient": "Todos", "message": f"{client_id} se ha unido", "timestamp": now, "is_group": False})
-        await manager.broadcast(sys_msg)
-        
-        while True:
-            raw_data = await websocket.receive_text()
-            data_json = json.loads(raw_data)
-            tipo = data_json.get("action", "message") 
-
-            if tipo == "delete":
-                msg_id = data_json["id"]
-                if borrar_mensaje_db(msg_id, client_id):
-                    await manager.broadcast(json.dumps({"type": "DELETE", "id": msg_id}))
-            
-            else:
-                recipient = data_json["recipient"]
-                message = data_json["message"]
-                is_group = data_json.get("is_group", False)
-                hora_actual = datetime.utcnow().isoformat() + "Z"
-                
-                nuevo_id = guardar_mensaje_db(client_id, recipient, message, hora_actual, is_group)
-                resp = json.dumps({
-                    "type": "CHAT", "id": nuevo_id, "sender": client_id,
-                    "recipient": recipient, "message": message, "timestamp": hora_actual, "is_group": is_group
-                })
-                
-                if recipient == "Chat General":
-                    await manager.broadcast(resp)
-                elif is_group:
-                    info_grupo = obtener_info_grupo_db(recipient)
-                    if info_grupo:
-                        await manager.broadcast_to_group(resp, info_grupo["miembros"])
-                else:
-                    await manager.send_personal_message(resp, recipient)
-                    await manager.send_personal_message(resp, client_id)
-            
-    except WebSocketDisconnect:
-        manager.disconnect(client_id)
-        await manager.broadcast_refresh()
-        await manager.broadcast_online_list()
-        now = datetime.utcnow().isoformat() + "Z"
-        sys_msg = json.dumps({"type": "CHAT", "sender": "Sistema", "recipient": "Todos", "message": f"{client_id} ha salido", "timestamp": now})
-        await manager.broadcast(sys_msg)
\ No newline at end of file
+import asyncio
+import os
+import sqlite3
+import hashlib
+import hmac
+import re
+import time
+
+import msgspec
+import orjson
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:
+    redis_asyncio = None
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi.staticfiles import StaticFiles
+from fastapi.responses import RedirectResponse, StreamingResponse
+from pydantic import BaseModel
+from typing import Dict, List, Optional, Set
+
+# FastAPI moderno ya serializa a bytes JSON de forma nativa; /historial, que
+# es la respuesta grande, sigue saliendo por orjson en streaming.
+app = FastAPI()
+
+app.mount("/static", StaticFiles(directory="static"), name="static")
+
+# Sala pública implícita: no existe como grupo en la base, su despacho se
+# resuelve por comparación directa en el camino caliente de mensajes.
+CHAT_GENERAL = "Chat General"
+
+# --- BASE DE DATOS ---
+
+# PRAGMAs de rendimiento: WAL permite lectores concurrentes con el escritor y
+# synchronous=NORMAL evita un fsync por commit (seguro bajo WAL).
+PRAGMAS_DB = """
+PRAGMA journal_mode=WAL;
+PRAGMA synchronous=NORMAL;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-64000;
+PRAGMA mmap_size=268435456;
+"""
+
+def init_db():
+    conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False)
+    # page_size sólo aplica si la base aún no existe; debe ir antes del CREATE
+    conn.execute("PRAGMA page_size=8192")
+    conn.executescript(PRAGMAS_DB)
+    c = conn.cursor()
+    # Sin AUTOINCREMENT: el rowid sigue siendo monótono para esta carga y se
+    # ahorra la actualización de sqlite_sequence en cada INSERT.
+    c.execute('''CREATE TABLE IF NOT EXISTS mensajes
+                 (id INTEGER PRIMARY KEY, sender TEXT, recipient TEXT, message TEXT, timestamp INTEGER, is_group INTEGER)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS usuarios
+                 (username TEXT PRIMARY KEY, password_hash TEXT, avatar TEXT, about TEXT) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS grupos
+                 (nombre TEXT PRIMARY KEY, creador TEXT, miembros TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS grupo_miembros
+                 (grupo TEXT, usuario TEXT, PRIMARY KEY(grupo, usuario))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_gm_usuario ON grupo_miembros(usuario)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_msg_recipient_id ON mensajes(recipient, id DESC)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_msg_sender ON mensajes(sender)')
+    # Migración única: bases viejas guardaban los miembros como JSON en
+    # grupos.miembros; se vuelca a la tabla normalizada la primera vez.
+    if c.execute("SELECT COUNT(*) FROM grupo_miembros").fetchone()[0] == 0:
+        for nombre, miembros in c.execute("SELECT nombre, miembros FROM grupos").fetchall():
+            if miembros:
+                c.executemany("INSERT OR IGNORE INTO grupo_miembros VALUES (?, ?)",
+                              [(nombre, u) for u in orjson.loads(miembros)])
+    conn.commit()
+    conn.close()
+
+init_db()
+
+# POOL DE CONEXIONES: un escritor + N lectores de sólo lectura. Bajo WAL los
+# lectores no bloquean al escritor, así que las consultas (/historial,
+# /lista-usuarios/, /mis-grupos/) corren en paralelo con los INSERT de chat.
+# Las consultas se ejecutan en un hilo para no frenar el event loop.
+NUM_LECTORES = 8
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=NUM_LECTORES + 1, thread_name_prefix="sqlite")
+
+def _abrir_conexion(solo_lectura=False):
+    if solo_lectura:
+        conn = sqlite3.connect('file:chat.db?mode=ro', uri=True, timeout=30, check_same_thread=False,
+                               isolation_level=None, cached_statements=256)
+        # WAL ya quedó fijado en el archivo; aquí sólo los PRAGMAs por conexión.
+        conn.executescript("PRAGMA temp_store=MEMORY; PRAGMA cache_size=-64000; PRAGMA mmap_size=268435456;")
+    else:
+        conn = sqlite3.connect('chat.db', timeout=30, check_same_thread=False,
+                               isolation_level=None, cached_statements=256)
+        conn.executescript(PRAGMAS_DB)
+    return conn
+
+class SQLitePool:
+    def __init__(self, lectores=NUM_LECTORES):
+        self._lectores = asyncio.Queue()
+        for _ in range(lectores):
+            self._lectores.put_nowait(_abrir_conexion(solo_lectura=True))
+        self._escritor = _abrir_conexion()
+        self._lock_escritor = asyncio.Lock()
+
+    @asynccontextmanager
+    async def lectura(self):
+        conn = await self._lectores.get()
+        try:
+            yield conn
+        finally:
+            self._lectores.put_nowait(conn)
+
+    @asynccontextmanager
+    async def escritura(self):
+        # SQLite serializa los escritores de todos modos: un lock asyncio evita
+        # que dos corutinas peleen por la misma conexión de escritura.
+        async with self._lock_escritor:
+            yield self._escritor
+
+# El pool se construye en el arranque de FastAPI (ver lanzar_tareas_fondo):
+# así importar el módulo no abre nueve conexiones, y procesos auxiliares
+# (scripts, herramientas) pueden importar sin tocar la base.
+pool: SQLitePool = None
+
+async def _en_hilo(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(DB_EXECUTOR, fn, *args)
+
+# SQL del camino caliente como constantes de módulo: al reusar el mismo
+# objeto str sobre conexiones vivas, el cache de sentencias preparadas de
+# sqlite3 acierta y se ahorra el parseo/planificación por llamada.
+SQL_INSERT_MSG = "INSERT INTO mensajes (sender, recipient, message, timestamp, is_group) VALUES (?, ?, ?, ?, ?)"
+SQL_BORRAR_MSG = "DELETE FROM mensajes WHERE id = ? AND sender = ?"
+# ?1 IS NULL permite usar la misma sentencia preparada con y sin cursor
+SQL_HISTORIAL = ("SELECT id, sender, recipient, message, timestamp, is_group FROM mensajes "
+                 "WHERE (?1 IS NULL OR id < ?1) ORDER BY id DESC LIMIT ?2")
+SQL_HISTORIAL_CHAT = ("SELECT id, sender, recipient, message, timestamp, is_group FROM mensajes "
+                      "WHERE recipient = ?1 AND (?2 IS NULL OR id < ?2) ORDER BY id DESC LIMIT ?3")
+SQL_TODOS_USUARIOS = "SELECT username, avatar, about FROM usuarios"
+SQL_SET_AVATAR = "UPDATE usuarios SET avatar = ? WHERE username = ?"
+SQL_SET_ABOUT = "UPDATE usuarios SET about = ? WHERE username = ?"
+SQL_INSERT_GRUPO = "INSERT INTO grupos VALUES (?, ?, NULL)"
+SQL_TODOS_GRUPOS = "SELECT nombre, creador FROM grupos"
+SQL_INSERT_MIEMBRO = "INSERT OR IGNORE INTO grupo_miembros VALUES (?, ?)"
+SQL_BORRAR_MIEMBROS = "DELETE FROM grupo_miembros WHERE grupo = ?"
+SQL_TODOS_MIEMBROS = "SELECT grupo, usuario FROM grupo_miembros"
+SQL_MIEMBROS_DE_GRUPO = "SELECT usuario FROM grupo_miembros WHERE grupo = ?"
+SQL_CREADOR_DE_GRUPO = "SELECT creador FROM grupos WHERE nombre = ?"
+SQL_PWD_USUARIO = "SELECT password_hash FROM usuarios WHERE username = ?"
+SQL_EXISTE_USUARIO = "SELECT username FROM usuarios WHERE username = ?"
+SQL_INSERT_USUARIO = "INSERT INTO usuarios VALUES (?, ?, ?, ?)"
+SQL_SET_PWD = "UPDATE usuarios SET password_hash = ? WHERE username = ?"
+
+# --- FUNCIONES ---
+
+# scrypt con sal por usuario: el primitivo correcto para contraseñas. Se
+# guarda sal(16) || hash(64). Cuesta ~100 ms a propósito, así que el cálculo
+# va a un hilo para que los WebSockets sigan fluyendo durante un login.
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2**14, 8, 1
+LARGO_SALT = 16
+
+def _hash_scrypt(password, salt):
+    return salt + hashlib.scrypt(password.encode(), salt=salt,
+                                 n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=64)
+
+async def hash_password(password):
+    return await asyncio.to_thread(_hash_scrypt, password, os.urandom(LARGO_SALT))
+
+async def verificar_password(password, guardado):
+    if isinstance(guardado, str):
+        # heredado: sha256 en hexadecimal
+        digest = hashlib.sha256(password.encode()).hexdigest()
+        return hmac.compare_digest(guardado.encode(), digest.encode())
+    if len(guardado) == 32:
+        # heredado: sha256 crudo
+        return hmac.compare_digest(guardado, hashlib.sha256(password.encode()).digest())
+    salt = guardado[:LARGO_SALT]
+    calculado = await asyncio.to_thread(_hash_scrypt, password, salt)
+    return hmac.compare_digest(guardado, calculado)
+
+def _es_hash_heredado(guardado):
+    return isinstance(guardado, str) or len(guardado) == 32
+
+def validar_password_fuerte(password):
+    if len(password) < 8: return "Mínimo 8 caracteres."
+    if not re.search(r"[A-Z]", password): return "Falta una mayúscula."
+    if not re.search(r"[a-z]", password): return "Falta una minúscula."
+    if not re.search(r"\d", password): return "Falta un número."
+    return True
+
+# Cola de escritura de mensajes: en vez de un commit (y su fsync) por mensaje,
+# un flusher de fondo agrupa lo pendiente y lo inserta en UNA transacción.
+# Cada productor espera su future, que se resuelve con el id asignado.
+COLA_MENSAJES: asyncio.Queue = asyncio.Queue()
+TAM_LOTE = 100
+ESPERA_LOTE = 0.01  # segundos que el flusher espera para juntar un lote
+
+async def _flusher_mensajes():
+    while True:
+        pendientes = [await COLA_MENSAJES.get()]
+        try:
+            async with asyncio.timeout(ESPERA_LOTE):
+                while len(pendientes) < TAM_LOTE:
+                    pendientes.append(await COLA_MENSAJES.get())
+        except TimeoutError:
+            pass
+        filas = [fila for fila, _ in pendientes]
+        async with pool.escritura() as conn:
+            def _insertar_lote():
+                c = conn.cursor()
+                c.execute("BEGIN")
+                try:
+                    c.executemany(SQL_INSERT_MSG, filas)
+                    ultimo = c.execute("SELECT last_insert_rowid()").fetchone()[0]
+                    c.execute("COMMIT")
+                except Exception:
+                    c.execute("ROLLBACK")
+                    raise
+                return ultimo
+            try:
+                ultimo = await _en_hilo(_insertar_lote)
+            except Exception as e:
+                for _, fut in pendientes:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+        # ids consecutivos dentro de la transacción: reconstruimos cada uno
+        primero = ultimo - len(pendientes) + 1
+        for i, (_, fut) in enumerate(pendientes):
+            if not fut.done():
+                fut.set_result(primero + i)
+
+async def guardar_mensaje_db(sender, recipient, message, timestamp, is_group):
+    fut = asyncio.get_running_loop().create_future()
+    await COLA_MENSAJES.put(((sender, recipient, message, timestamp, 1 if is_group else 0), fut))
+    return await fut
+
+async def borrar_mensaje_db(msg_id, sender):
+    async with pool.escritura() as conn:
+        def _borrar():
+            c = conn.cursor()
+            c.execute(SQL_BORRAR_MSG, (msg_id, sender))
+            return c.rowcount > 0
+        return await _en_hilo(_borrar)
+
+async def obtener_mensajes_db(recipient=None, before_id=None, limit=500):
+    async with pool.lectura() as conn:
+        def _consultar():
+            if recipient is not None:
+                filas = conn.execute(SQL_HISTORIAL_CHAT, (recipient, before_id, limit)).fetchall()
+            else:
+                filas = conn.execute(SQL_HISTORIAL, (before_id, limit)).fetchall()
+            filas.reverse()  # la consulta pagina hacia atrás; el cliente pinta ascendente
+            return [{"id": m[0], "sender": m[1], "recipient": m[2], "message": m[3], "timestamp": m[4], "is_group": bool(m[5])} for m in filas]
+        return await _en_hilo(_consultar)
+
+async def obtener_usuarios_db():
+    async with pool.lectura() as conn:
+        def _consultar():
+            users = conn.execute(SQL_TODOS_USUARIOS).fetchall()
+            return [{"username": u[0], "avatar": u[1] if u[1] else "", "about": u[2] if u[2] else "¡Hola! Uso TecChat"} for u in users]
+        return await _en_hilo(_consultar)
+
+async def actualizar_avatar_db(username, nueva_url):
+    async with pool.escritura() as conn:
+        await _en_hilo(conn.execute, SQL_SET_AVATAR, (nueva_url, username))
+
+async def actualizar_about_db(username, nuevo_about):
+    async with pool.escritura() as conn:
+        await _en_hilo(conn.execute, SQL_SET_ABOUT, (nuevo_about, username))
+
+# Caché en memoria de grupos (miembros + creador): se llena una vez desde las
+# tablas y las escrituras la actualizan, así ni el camino de mensajes ni los
+# endpoints de grupo vuelven a tocar la base para leer.
+MIEMBROS_GRUPO: Dict[str, List[str]] = {}
+CREADOR_GRUPO: Dict[str, str] = {}
+_miembros_cargado = False
+_candado_miembros = asyncio.Lock()
+
+async def _asegurar_cache_miembros():
+    global _miembros_cargado
+    if _miembros_cargado:
+        return
+    # Con caché fría las reconexiones llegan en ráfaga (el cliente recarga a
+    # los 3s): sin candado, dos corrutinas duplicarían cada miembro al
+    # rellenar con setdefault/append. Segunda comprobación bajo el candado.
+    async with _candado_miembros:
+        if _miembros_cargado:
+            return
+        async with pool.lectura() as conn:
+            def _cargar():
+                return (conn.execute(SQL_TODOS_MIEMBROS).fetchall(),
+                        conn.execute(SQL_TODOS_GRUPOS).fetchall())
+            filas, grupos = await _en_hilo(_cargar)
+        for grupo, usuario in filas:
+            MIEMBROS_GRUPO.setdefault(grupo, []).append(usuario)
+        for nombre, creador in grupos:
+            CREADOR_GRUPO[nombre] = creador
+        _miembros_cargado = True
+
+async def crear_grupo_db(nombre, creador, miembros_lista):
+    await _asegurar_cache_miembros()
+    async with pool.escritura() as conn:
+        def _crear():
+            c = conn.cursor()
+            c.execute("BEGIN")
+            try:
+                c.execute(SQL_INSERT_GRUPO, (nombre, creador))
+                c.executemany(SQL_INSERT_MIEMBRO, [(nombre, u) for u in miembros_lista])
+                c.execute("COMMIT")
+                return True
+            except sqlite3.IntegrityError:
+                c.execute("ROLLBACK")
+                return False
+        exito = await _en_hilo(_crear)
+    if exito:
+        MIEMBROS_GRUPO[nombre] = list(miembros_lista)
+        CREADOR_GRUPO[nombre] = creador
+    return exito
+
+async def obtener_info_grupo_db(nombre_grupo):
+    await _asegurar_cache_miembros()
+    creador = CREADOR_GRUPO.get(nombre_grupo)
+    if creador is None:
+        return None
+    return {"nombre": nombre_grupo, "creador": creador, "miembros": list(MIEMBROS_GRUPO.get(nombre_grupo, []))}
+
+async def modificar_miembros_grupo_db(nombre_grupo, nueva_lista):
+    async with pool.escritura() as conn:
+        def _reescribir():
+            c = conn.cursor()
+            c.execute("BEGIN")
+            try:
+                c.execute(SQL_BORRAR_MIEMBROS, (nombre_grupo,))
+                c.executemany(SQL_INSERT_MIEMBRO, [(nombre_grupo, u) for u in nueva_lista])
+                c.execute("COMMIT")
+            except Exception:
+                c.execute("ROLLBACK")
+                raise
+        await _en_hilo(_reescribir)
+    MIEMBROS_GRUPO[nombre_grupo] = list(nueva_lista)
+
+async def obtener_grupos_usuario(username):
+    await _asegurar_cache_miembros()
+    return [{"nombre": nombre, "miembros": miembros}
+            for nombre, miembros in MIEMBROS_GRUPO.items() if username in miembros]
+
+# --- MODELOS ---
+class UserAuth(BaseModel):
+    username: str
+    password: str
+
+class UserUpdate(BaseModel):
+    username: str
+    avatar_url: Optional[str] = None
+    about: Optional[str] = None
+
+class NewGroup(BaseModel):
+    nombre: str
+    creador: str
+    miembros: List[str]
+
+class GroupAction(BaseModel):
+    nombre_grupo: str
+    solicitante: str
+    target_user: str
+
+# Tramas entrantes del WebSocket: unión etiquetada por "action". msgspec
+# decodifica el JSON directo a atributos tipados, sin dict intermedio.
+class ChatIn(msgspec.Struct, tag_field="action", tag="message"):
+    recipient: str
+    message: str
+    is_group: bool = False
+
+class DeleteIn(msgspec.Struct, tag_field="action", tag="delete"):
+    id: int
+
+# Trama CHAT saliente con forma fija: msgspec genera código de codificación
+# especializado para el layout del struct, en vez de recorrer un dict.
+class ChatOut(msgspec.Struct):
+    type: str
+    id: int
+    sender: str
+    recipient: str
+    message: str
+    timestamp: int  # epoch en milisegundos; el cliente formatea la hora local
+    is_group: bool
+
+# Tramas en MessagePack: mismo esquema que el JSON anterior pero binario.
+# Menos bytes en el cable y (de)codificación en C por los dos lados.
+WS_DECODER = msgspec.msgpack.Decoder(ChatIn | DeleteIn)
+WS_DECODER_JSON = msgspec.json.Decoder(ChatIn | DeleteIn)
+WS_ENCODER = msgspec.msgpack.Encoder()
+empaquetar = WS_ENCODER.encode
+
+class ConnectionManager:
+    def __init__(self):
+        self.active_connections: Dict[str, WebSocket] = {}
+        # Salas por grupo: cada mensaje grupal toca sólo a los suscritos
+        # conectados, en vez de recorrer la lista completa de miembros.
+        self.rooms: Dict[str, Set[str]] = defaultdict(set)
+        # Lista de conectados mantenida incrementalmente + STATUS cacheado;
+        # el flag "sucio" evita reconstruir y re-emitir cuando no hubo cambio.
+        self._online: List[str] = []
+        self._online_sucio = False
+        # Pre-codificado: una reconexión antes del primer volcado recibe un
+        # STATUS vacío válido, nunca una trama de cero bytes.
+        self._buf_online = empaquetar({"type": "STATUS", "online_users": []})
+        self._tarea_status: Optional[asyncio.Task] = None
+        # Clientes que no negociaron el subprotocolo "msgpack": reciben las
+        # mismas tramas transcodificadas a JSON de texto.
+        self.json_clients: Set[str] = set()
+
+    async def connect(self, websocket: WebSocket, client_id: str):
+        ofrecidos = websocket.scope.get("subprotocols") or []
+        if "msgpack" in ofrecidos:
+            await websocket.accept(subprotocol="msgpack")
+        else:
+            await websocket.accept()
+            self.json_clients.add(client_id)
+        ya_estaba = client_id in self.active_connections
+        self.active_connections[client_id] = websocket
+        if not ya_estaba:
+            self._online.append(client_id)
+            self._online_sucio = True
+        await self.broadcast_refresh()
+        await self.broadcast_online_list()
+        if ya_estaba:
+            # Reconexión sin cambio de conjunto: el broadcast se saltó, pero
+            # el socket nuevo sí necesita el STATUS cacheado.
+            await self._enviar_uno(websocket, client_id, self._buf_online)
+
+    def disconnect(self, client_id: str):
+        if client_id in self.active_connections:
+            del self.active_connections[client_id]
+            self._online.remove(client_id)
+            self._online_sucio = True
+        self.json_clients.discard(client_id)
+        for miembros in self.rooms.values():
+            miembros.discard(client_id)
+
+    def subscribe(self, room: str, client_id: str):
+        self.rooms[room].add(client_id)
+
+    def unsubscribe(self, room: str, client_id: str):
+        self.rooms[room].discard(client_id)
+
+    # Todas las emisiones reciben el payload ya codificado (bytes): se
+    # serializa UNA vez por evento y send_bytes evita re-codificar a utf-8
+    # por cada socket, como hacía send_text.
+    async def _enviar_uno(self, websocket: WebSocket, client_id: str, buf: bytes):
+        if client_id in self.json_clients:
+            await websocket.send_text(orjson.dumps(desempaquetar(buf)).decode())
+        else:
+            await websocket.send_bytes(buf)
+
+    async def send_many(self, buf: bytes, ids):
+        # Fanout en paralelo: un socket lento ya no frena a los demás.
+        # Los sockets que fallan se dan de baja aquí mismo. La intersección
+        # con los conectados se hace en C, sin probar miembro por miembro.
+        conectados = self.active_connections.keys() & ids
+        if not conectados:
+            return
+        # Si hay clientes JSON conectados, la trama se transcodifica UNA vez.
+        texto = None
+        if self.json_clients and (conectados & self.json_clients):
+            texto = orjson.dumps(desempaquetar(buf)).decode()
+        pares, tareas = [], []
+        for cid in conectados:
+            ws = self.active_connections[cid]
+            pares.append(cid)
+            if texto is not None and cid in self.json_clients:
+                tareas.append(ws.send_text(texto))
+            else:
+                tareas.append(ws.send_bytes(buf))
+        resultados = await asyncio.gather(*tareas, return_exceptions=True)
+        for cid, res in zip(pares, resultados):
+            if isinstance(res, Exception):
+                self.disconnect(cid)
+
+    async def broadcast_online_list(self):
+        # En tormentas de reconexión el conjunto suele no cambiar: el flag
+        # evita re-serializar y re-emitir la misma lista N veces. Y cuando
+        # sí cambia, el volcado se difiere un tick para que K altas/bajas
+        # seguidas produzcan UN solo frame STATUS en vez de K.
+        if not self._online_sucio or self._tarea_status is not None:
+            return
+        self._tarea_status = asyncio.create_task(self._volcar_status())
+
+    async def _volcar_status(self):
+        await asyncio.sleep(0.01)
+        while self._online_sucio:
+            self._online_sucio = False
+            self._buf_online = empaquetar({"type": "STATUS", "online_users": self._online})
+            await self.send_many(self._buf_online, self._online)
+        self._tarea_status = None
+
+    async def broadcast_refresh(self):
+        buf = empaquetar({"type": "REFRESH_USERS"})
+        await self.send_many(buf, list(self.active_connections.keys()))
+
+    async def broadcast(self, buf: bytes):
+        await self.send_many(buf, list(self.active_connections.keys()))
+
+    async def broadcast_room(self, buf: bytes, room: str):
+        await self.send_many(buf, self.rooms.get(room, set()))
+
+manager = ConnectionManager()
+
+# --- PUB/SUB ENTRE WORKERS ---
+# Con varios workers de uvicorn (detrás de nginx con sesiones pegajosas) cada
+# proceso sólo ve sus propios sockets. Si REDIS_URL está definida, cada
+# emisión de chat se publica a un canal de Redis y todos los workers —este
+# incluido— la reparten a sus conexiones locales. Los cambios de membresía
+# viajan por el mismo canal como eventos "grupo": cada worker recarga ese
+# grupo desde la base, así su caché y sus salas no quedan desfasados respecto
+# al worker que atendió el HTTP. Sin REDIS_URL todo queda local, igual que
+# antes. La lista de "en línea" sigue siendo por worker.
+REDIS_URL = os.environ.get("REDIS_URL")
+CANAL_EVENTOS = "tecchat:eventos"
+desempaquetar = msgspec.msgpack.decode
+_redis = None
+
+async def _repartir_local(ev):
+    # Reparto a las conexiones de ESTE worker; lo usan tanto el listener de
+    # Redis como el camino sin Redis (o con Redis caído).
+    if ev["modo"] == "todos":
+        await manager.broadcast(ev["payload"])
+    elif ev["modo"] == "sala":
+        await manager.broadcast_room(ev["payload"], ev["destino"])
+    elif ev["modo"] == "grupo":
+        await _recargar_grupo(ev["destino"])
+    else:
+        await manager.send_many(ev["payload"], ev["destino"])
+
+async def _recargar_grupo(nombre: str):
+    # Relee UN grupo desde la base y pisa la entrada local de la caché y la
+    # sala. Idempotente: el worker que publicó el cambio también se recarga.
+    async with pool.lectura() as conn:
+        def _leer():
+            miembros = [f[0] for f in conn.execute(SQL_MIEMBROS_DE_GRUPO, (nombre,)).fetchall()]
+            fila = conn.execute(SQL_CREADOR_DE_GRUPO, (nombre,)).fetchone()
+            return miembros, fila
+        miembros, fila = await _en_hilo(_leer)
+    if fila is None:
+        MIEMBROS_GRUPO.pop(nombre, None)
+        CREADOR_GRUPO.pop(nombre, None)
+        manager.rooms.pop(nombre, None)
+        return
+    MIEMBROS_GRUPO[nombre] = miembros
+    CREADOR_GRUPO[nombre] = fila[0]
+    manager.rooms[nombre] = set(miembros)
+
+async def emitir_grupo_cambiado(nombre: str):
+    # Sólo tiene sentido entre workers: sin Redis la escritura local ya dejó
+    # caché y sala al día.
+    if _redis:
+        await _emitir({"modo": "grupo", "destino": nombre, "payload": b""})
+
+async def _emitir(ev):
+    if _redis:
+        try:
+            await _redis.publish(CANAL_EVENTOS, empaquetar(ev))
+            return
+        except Exception:
+            # Redis caído: no matar la conexión del emisor; al menos los
+            # sockets locales reciben el evento mientras el listener reintenta.
+            pass
+    await _repartir_local(ev)
+
+async def emitir_todos(buf: bytes):
+    await _emitir({"modo": "todos", "destino": None, "payload": buf})
+
+async def emitir_sala(buf: bytes, sala: str):
+    await _emitir({"modo": "sala", "destino": sala, "payload": buf})
+
+async def emitir_directo(buf: bytes, destinos):
+    # destinos es un conjunto de ids: un solo fanout con el buffer compartido
+    await _emitir({"modo": "directo", "destino": sorted(destinos), "payload": buf})
+
+async def _escuchar_redis():
+    # Bucle con reintento: si la conexión a Redis se cae, el listener no debe
+    # morir en silencio — se re-suscribe con espera creciente.
+    espera = 1
+    while True:
+        try:
+            ps = _redis.pubsub()
+            await ps.subscribe(CANAL_EVENTOS)
+            espera = 1
+            async for mensaje in ps.listen():
+                if mensaje["type"] != "message":
+                    continue
+                await _repartir_local(desempaquetar(mensaje["data"]))
+        except Exception:
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, 30)
+
+@app.on_event("startup")
+async def lanzar_tareas_fondo():
+    global pool, _redis
+    pool = SQLitePool()
+    asyncio.create_task(_flusher_mensajes())
+    if REDIS_URL and redis_asyncio is not None:
+        _redis = redis_asyncio.from_url(REDIS_URL)
+        asyncio.create_task(_escuchar_redis())
+
+# --- RUTAS ---
+
+@app.get("/")
+async def get():
+    return RedirectResponse(url="/static/index.html")
+
+@app.post("/login")
+async def login(user: UserAuth):
+    async with pool.lectura() as conn:
+        row = await _en_hilo(lambda: conn.execute(SQL_PWD_USUARIO, (user.username,)).fetchone())
+    if not row: raise HTTPException(status_code=404, detail="Usuario no encontrado.")
+    valido = await verificar_password(user.password, row[0])
+    if not valido: raise HTTPException(status_code=401, detail="Contraseña incorrecta.")
+    if _es_hash_heredado(row[0]):
+        # Migración al vuelo de hashes sha256 viejos hacia scrypt con sal.
+        nuevo = await hash_password(user.password)
+        async with pool.escritura() as conn:
+            await _en_hilo(conn.execute, SQL_SET_PWD, (nuevo, user.username))
+    return {"message": "Login exitoso"}
+
+@app.post("/signup")
+async def signup(user: UserAuth):
+    val = validar_password_fuerte(user.password)
+    if val != True: raise HTTPException(status_code=400, detail=val)
+
+    hash_nuevo = await hash_password(user.password)
+    async with pool.escritura() as conn:
+        existe = await _en_hilo(lambda: conn.execute(SQL_EXISTE_USUARIO, (user.username,)).fetchone())
+        if existe:
+            raise HTTPException(status_code=400, detail="Usuario existente.")
+        await _en_hilo(conn.execute, SQL_INSERT_USUARIO,
+                       (user.username, hash_nuevo, None, "Disponible"))
+    return {"message": "Creado"}
+
+@app.post("/update-avatar")
+async def update_avatar(data: UserUpdate):
+    await actualizar_avatar_db(data.username, data.avatar_url)
+    return {"message": "Avatar actualizado"}
+
+@app.post("/update-about")
+async def update_about(data: UserUpdate):
+    await actualizar_about_db(data.username, data.about)
+    return {"message": "Estado actualizado"}
+
+@app.post("/crear-grupo")
+async def create_group(grupo: NewGroup):
+    members = list(set(grupo.miembros))
+    if grupo.creador not in members: members.append(grupo.creador)
+    if len(members) < 1: raise HTTPException(status_code=400, detail="Faltan miembros")
+    exito = await crear_grupo_db(grupo.nombre, grupo.creador, members)
+    if not exito: raise HTTPException(status_code=400, detail="El grupo ya existe")
+    for m in members:
+        manager.subscribe(grupo.nombre, m)
+    await emitir_grupo_cambiado(grupo.nombre)
+    return {"message": "Grupo creado"}
+
+@app.get("/mis-grupos/{username}")
+async def get_my_groups(username: str):
+    return await obtener_grupos_usuario(username)
+
+@app.get("/grupo/{nombre}")
+async def get_group_info(nombre: str):
+    return await obtener_info_grupo_db(nombre)
+
+@app.post("/grupo/agregar")
+async def add_member(action: GroupAction):
+    info = await obtener_info_grupo_db(action.nombre_grupo)
+    if not info: raise HTTPException(404, "Grupo no existe")
+    if action.solicitante not in info["miembros"]: raise HTTPException(403, "No eres del grupo")
+    if action.target_user not in info["miembros"]:
+        info["miembros"].append(action.target_user)
+        await modificar_miembros_grupo_db(action.nombre_grupo, info["miembros"])
+        manager.subscribe(action.nombre_grupo, action.target_user)
+        await emitir_grupo_cambiado(action.nombre_grupo)
+    return {"message": "Agregado"}
+
+@app.post("/grupo/expulsar")
+async def kick_member(action: GroupAction):
+    info = await obtener_info_grupo_db(action.nombre_grupo)
+    if not info: raise HTTPException(404, "Grupo no existe")
+    if info["creador"] != action.solicitante: raise HTTPException(403, "Solo el creador puede expulsar")
+    if action.target_user in info["miembros"]:
+        info["miembros"].remove(action.target_user)
+        await modificar_miembros_grupo_db(action.nombre_grupo, info["miembros"])
+        manager.unsubscribe(action.nombre_grupo, action.target_user)
+        await emitir_grupo_cambiado(action.nombre_grupo)
+    return {"message": "Expulsado"}
+
+@app.get("/lista-usuarios/")
+async def get_users():
+    return await obtener_usuarios_db()
+
+@app.get("/historial")
+async def get_history(recipient: Optional[str] = None, before_id: Optional[int] = None, limit: int = 500):
+    limit = max(1, min(limit, 500))
+    mensajes = await obtener_mensajes_db(recipient, before_id, limit)
+
+    # Respuesta en streaming: cada fila se codifica con orjson y sale al
+    # socket sin armar primero todo el JSON en memoria.
+    def _generar():
+        yield b"["
+        for i, m in enumerate(mensajes):
+            if i:
+                yield b","
+            yield orjson.dumps(m)
+        yield b"]"
+
+    return StreamingResponse(_generar(), media_type="application/json")
+
+@app.websocket("/ws/{client_id}")
+async def websocket_endpoint(websocket: WebSocket, client_id: str):
+    await manager.connect(websocket, client_id)
+    for g in await obtener_grupos_usuario(client_id):
+        manager.subscribe(g["nombre"], client_id)
+    try:
+        now = int(time.time() * 1000)
+        sys_msg = empaquetar({"type": "CHAT", "sender": "Sistema", "recipient": "Todos", "message": f"{client_id} se ha unido", "timestamp": now, "is_group": False})
+        await emitir_todos(sys_msg)
+
+        while True:
+            mensaje = await websocket.receive()
+            if mensaje["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(mensaje.get("code") or 1000)
+            raw_data = mensaje.get("bytes")
+            try:
+                if raw_data is not None:
+                    entrada = WS_DECODER.decode(raw_data)
+                else:
+                    # cliente sin msgpack: misma trama pero en JSON de texto
+                    entrada = WS_DECODER_JSON.decode(mensaje["text"])
+            except (msgspec.DecodeError, msgspec.ValidationError):
+                # Trama malformada (cliente roto o bytes basura): se descarta
+                # sin tumbar la conexión. El decoder ya validó tipos y campos.
+                continue
+
+            if isinstance(entrada, DeleteIn):
+                if await borrar_mensaje_db(entrada.id, client_id):
+                    await emitir_todos(empaquetar({"type": "DELETE", "id": entrada.id}))
+
+            else:
+                recipient = entrada.recipient
+                message = entrada.message
+                is_group = entrada.is_group
+                hora_actual = int(time.time() * 1000)
+
+                nuevo_id = await guardar_mensaje_db(client_id, recipient, message, hora_actual, is_group)
+                resp = empaquetar(ChatOut("CHAT", nuevo_id, client_id, recipient, message, hora_actual, is_group))
+
+                if recipient == CHAT_GENERAL:
+                    # atajo: la sala pública no pasa por caché de grupos ni salas
+                    await emitir_todos(resp)
+                elif is_group:
+                    await emitir_sala(resp, recipient)
+                else:
+                    # un solo envío cubre destinatario y eco al emisor
+                    await emitir_directo(resp, {recipient, client_id})
+
+    except WebSocketDisconnect:
+        manager.disconnect(client_id)
+        await manager.broadcast_refresh()
+        await manager.broadcast_online_list()
+        now = int(time.time() * 1000)
+        sys_msg = empaquetar({"type": "CHAT", "sender": "Sistema", "recipient": "Todos", "message": f"{client_id} ha salido", "timestamp": now})
+        await emitir_todos(sys_msg)
+
+if __name__ == "__main__":
+    import uvicorn
+    # uvloop + parsers en C (httptools/websockets) de uvicorn[standard]:
+    # menos syscalls por recv y sin parseo de frames en Python puro.
+    uvicorn.run("main:app", host="0.0.0.0", port=8000,
+                loop="uvloop", http="httptools", ws="websockets", access_log=False)